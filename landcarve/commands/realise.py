@@ -1,9 +1,9 @@
-import collections
-
 import click
+import mmap
 import numpy
 import struct
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from landcarve.cli import main
 from landcarve.constants import NODATA
@@ -26,6 +26,12 @@ from landcarve.utils.io import raster_to_array
 )
 @click.option("--solid/--not-solid", default=False, help="Force a solid, square base")
 @click.option("--flipy/--no-flipy", default=False, help="Flip model Y axis")
+@click.option(
+    "--processes",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Processes to calculate the mesh with",
+)
 @click.pass_context
 def realise(
     ctx,
@@ -40,6 +46,7 @@ def realise(
     simplify,
     solid,
     flipy,
+    processes,
 ):
     """
     Turns a DEM array into a 3D model.
@@ -48,125 +55,276 @@ def realise(
     arr = raster_to_array(input_path)
     if flipy:
         arr = numpy.flipud(arr)
-    # Open the target STL file
-    mesh = Mesh(scale=(xy_scale, xy_scale, z_scale), z_reduction=z_scale_reduction)
+    # Vertices are keyed by their array position, which has to fit in 16 bits
+    if max(arr.shape) > Mesh.max_position + 1:
+        raise click.ClickException(
+            "Input is %ix%i, but realise can only handle up to %i cells on a "
+            "side; use decifit to shrink it first"
+            % (arr.shape[1], arr.shape[0], Mesh.max_position + 1)
+        )
+    # Open the target STL file, with its base the right thickness below zero
+    mesh = Mesh(
+        scale=(xy_scale, xy_scale, z_scale),
+        z_reduction=z_scale_reduction,
+        bottom=0 - (base / z_scale),
+    )
+    # Work in float32, which is what the STL stores anyway
+    arr = arr.astype(numpy.float32)
     # Apply the maximum constraint if there is one
     if maximum < 9999:
-        arr = numpy.vectorize(lambda x: min(maximum, x), otypes=[object])(arr)
-    # Apply the minimum constraint
+        arr = numpy.minimum(arr, maximum)
+    # Apply the minimum constraint. Anything that should not be rendered
+    # ends up as NODATA.
     if solid:
-        arr = numpy.vectorize(
-            lambda x: max(0, x - minimum) if x > NODATA else 0, otypes=[object]
-        )(arr)
+        arr = numpy.where(arr > NODATA, numpy.maximum(arr - minimum, 0), 0)
     else:
-        arr = numpy.vectorize(
-            lambda x: max(0, x - minimum) if x > minimum else None, otypes=[object]
-        )(arr)
+        arr = numpy.where(arr > minimum, arr - minimum, NODATA)
     # Work out bounds and print them
-    max_value = 0
-    for index, value in numpy.ndenumerate(arr):
-        if value and value > max_value:
-            max_value = value
+    max_value = max(arr.max(), 0)
     print(
         f"X size: {arr.shape[1]*xy_scale:.2f}  Y size: {arr.shape[0]*xy_scale:.2f}  Z size: {max_value*z_scale:.2f}"
     )
-    # For each value in the array, output appropriate polygons
-    bottom = 0 - (base / z_scale)
-    with click.progressbar(length=arr.shape[0], label="Calculating mesh") as bar:
-        for index, value in numpy.ndenumerate(arr):
-            if index[1] == 0:
-                bar.update(1)
-            if value is not None:
-                # Work out the neighbour values
-                # Arranged like so:
-                #       t   tr
-                #   l   c---r
-                #       b
-                c = (index[0], index[1], value)
-                t = get_neighbour_value((index[0], index[1] - 1), arr)
-                tr = get_neighbour_value((index[0] + 1, index[1] - 1), arr)
-                tl = get_neighbour_value((index[0] - 1, index[1] - 1), arr)
-                l = get_neighbour_value((index[0] - 1, index[1]), arr)
-                r = get_neighbour_value((index[0] + 1, index[1]), arr)
-                bl = get_neighbour_value((index[0] - 1, index[1] + 1), arr)
-                b = get_neighbour_value((index[0], index[1] + 1), arr)
-                br = get_neighbour_value((index[0] + 1, index[1] + 1), arr)
-                # Centre-Right-Bottom triangle
-                if r[2] is not None and b[2] is not None:
-                    mesh.add_surface(c, r, b, bottom)
-                    # Add diagonal edge if BR is nonexistent
-                    if br[2] is None:
-                        mesh.add_edge(b, r, bottom)
-                    # Top edge
-                    if t[2] is None and tr[2] is None:
-                        mesh.add_edge(r, c, bottom)
-                    # Left edge
-                    if l[2] is None and bl[2] is None:
-                        mesh.add_edge(c, b, bottom)
-                # Top-centre-left triangle
-                if t[2] is not None and l[2] is not None:
-                    mesh.add_surface(t, c, l, bottom)
-                    # Add diagonal edge if TL is nonexistent
-                    if tl[2] is None:
-                        mesh.add_edge(t, l, bottom)
-                    # Right edge
-                    if r[2] is None and tr[2] is None:
-                        mesh.add_edge(c, t, bottom)
-                    # Bottom edge
-                    if b[2] is None and bl[2] is None:
-                        mesh.add_edge(l, c, bottom)
-                # Top-right-center triangle (if tr doesn't exist)
-                if t[2] is not None and r[2] is not None and tr[2] is None:
-                    mesh.add_surface(t, r, c, bottom)
-                    # Also implies there must be an edge there
-                    mesh.add_edge(r, t, bottom)
-                    # See if it needs a left edge
-                    if l[2] is None and tl[2] is None:
-                        mesh.add_edge(t, c, bottom)
-                    # Bottom edge
-                    if b[2] is None and br[2] is None:
-                        mesh.add_edge(c, r, bottom)
-                # Left-center-bottom triangle (if bl doesn't exist)
-                if l[2] is not None and b[2] is not None and bl[2] is None:
-                    mesh.add_surface(l, c, b, bottom)
-                    # Also implies there must be an edge there
-                    mesh.add_edge(l, b, bottom)
-                    # See if it needs a right edge
-                    if r[2] is None and br[2] is None:
-                        mesh.add_edge(b, c, bottom)
-                    # And a top edge
-                    if t[2] is None and tr[2] is None:
-                        mesh.add_edge(c, l, bottom)
+    # Output appropriate polygons for each tile of the array, farming the
+    # tiles out to other processes if there's more than one to use
+    tiles = array_tiles(arr.shape)
+    # The progress bar counts cells, updated once per tile, as edge tiles
+    # can be much smaller than the rest
+    with click.progressbar(length=arr.size, label="Calculating mesh") as bar:
+        if processes == 1 or len(tiles) == 1:
+            for tile in tiles:
+                build_mesh(arr, mesh, *tile)
+                bar.update(tile_size(tile))
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                for tile, (normals, keys) in zip(
+                    tiles,
+                    executor.map(
+                        build_tile,
+                        *zip(*[tile_block(arr, tile) for tile in tiles]),
+                        [mesh.bottom] * len(tiles),
+                    ),
+                ):
+                    mesh.add_faces(normals, keys)
+                    bar.update(tile_size(tile))
     # Simplify
     if simplify:
         click.echo("Simplifying mesh  [", err=True, nl=False)
-        total_removed = 0
-        while True:
-            removed = mesh.simplify()
-            click.echo(".", nl=False)
-            if not removed:
-                break
-            total_removed += removed
+        total_removed = mesh.simplify(progress=lambda: click.echo(".", nl=False))
         click.echo("] %i vertices removed" % total_removed)
     # All done!
     click.echo("Writing STL...", err=True)
     mesh.save(output_path)
 
 
-def get_neighbour_value(index, arr):
+# A single binary STL facet: normal, three vertices, attribute byte count
+STL_DTYPE = numpy.dtype(
+    [
+        ("normal", "<3f4"),
+        ("v1", "<3f4"),
+        ("v2", "<3f4"),
+        ("v3", "<3f4"),
+        ("attributes", "<u2"),
+    ]
+)
+# The binary STL header: 80 bytes of text, then the number of facets
+STL_HEADER = struct.Struct("<80sL")
+
+# Size of the tiles of the array to turn into mesh at a time. Each tile's
+# working set (the padded heights plus a few dozen masks) fits in L2 cache;
+# tiles are wider than they are tall as rows are contiguous in memory.
+TILE_ROWS = 64
+TILE_COLS = 256
+
+# Neighbour offsets (row, column), arranged like so:
+#       t   tr
+#   l   c---r
+#       b
+C = (0, 0)
+T = (0, -1)
+TR = (1, -1)
+TL = (-1, -1)
+L = (-1, 0)
+R = (1, 0)
+BL = (-1, 1)
+B = (0, 1)
+BR = (1, 1)
+
+
+def morton_key(row, col):
     """
-    Gets a neighbour value. Puts None in place for NODATA or edge of array.
+    Interleaves the bits of row and col into a Morton (Z-order) key, so
+    sorting by it keeps positions that are near in both directions near in
+    the order.
     """
-    if (
-        index[0] < 0
-        or index[0] >= arr.shape[0]
-        or index[1] < 0
-        or index[1] >= arr.shape[1]
-    ):
-        return (index[0], index[1], None)
-    else:
-        value = arr[index]
-        return (index[0], index[1], value)
+    key = 0
+    for bit in range(max(row.bit_length(), col.bit_length())):
+        key |= ((row >> bit) & 1) << (2 * bit + 1)
+        key |= ((col >> bit) & 1) << (2 * bit)
+    return key
+
+
+def array_tiles(shape):
+    """
+    Returns a list of (first_row, last_row, first_col, last_col) tiles
+    covering an array of the given shape, in Morton order, so neighbouring
+    tiles (and their shared edge rows and columns) are visited close
+    together.
+    """
+    tiles = [
+        (tile_row, tile_col)
+        for tile_row in range((shape[0] + TILE_ROWS - 1) // TILE_ROWS)
+        for tile_col in range((shape[1] + TILE_COLS - 1) // TILE_COLS)
+    ]
+    tiles.sort(key=lambda tile: morton_key(*tile))
+    return [
+        (
+            tile_row * TILE_ROWS,
+            min((tile_row + 1) * TILE_ROWS, shape[0]),
+            tile_col * TILE_COLS,
+            min((tile_col + 1) * TILE_COLS, shape[1]),
+        )
+        for tile_row, tile_col in tiles
+    ]
+
+
+def tile_size(tile):
+    """
+    Returns the number of cells in a tile.
+    """
+    first_row, last_row, first_col, last_col = tile
+    return (last_row - first_row) * (last_col - first_col)
+
+
+def tile_block(arr, tile):
+    """
+    Cuts out a tile of the array, plus a cell either side where there is one,
+    so it can be built on its own. Returns the block, where its top-left cell
+    is in the array, and the tile's position within the block.
+    """
+    first_row, last_row, first_col, last_col = tile
+    top = max(first_row - 1, 0)
+    left = max(first_col - 1, 0)
+    block = arr[top : last_row + 1, left : last_col + 1]
+    return (
+        block,
+        (top, left),
+        (first_row - top, last_row - top, first_col - left, last_col - left),
+    )
+
+
+def build_tile(block, origin, tile, bottom):
+    """
+    Builds one tile of a DEM array (as cut out by tile_block) into a mesh of
+    its own. Used to build tiles in other processes; returns the normals and
+    vertex keys of its faces, for the main Mesh to add.
+    """
+    mesh = Mesh(scale=(1, 1, 1), bottom=bottom)
+    build_mesh(block, mesh, *tile, origin=origin)
+    return mesh.normals[: mesh.n_faces], mesh.pending_keys[: mesh.n_pending]
+
+
+def build_mesh(
+    arr, mesh, first_row=0, last_row=None, first_col=0, last_col=None, origin=(0, 0)
+):
+    """
+    Adds the surfaces and edges for a DEM array (or just one tile of it) to
+    the mesh. Cells that are NODATA are left empty. If arr is only part of
+    the whole DEM, origin is where its top-left cell is in the whole thing.
+
+    Works on all the cells at once; each kind of triangle (and edge) is
+    found with a boolean mask over all the cells, then added in bulk.
+    """
+    if last_row is None:
+        last_row = arr.shape[0]
+    if last_col is None:
+        last_col = arr.shape[1]
+    num_rows = last_row - first_row
+    num_cols = last_col - first_col
+    # Copy out the tile, plus a cell either side, padded with NODATA so
+    # neighbours off the edge look empty. Padded cell (p, q) is array cell
+    # (first_row + p - 1, first_col + q - 1).
+    padded = numpy.full((num_rows + 2, num_cols + 2), NODATA, dtype=numpy.float32)
+    halo_top = max(first_row - 1, 0)
+    halo_bottom = min(last_row + 1, arr.shape[0])
+    halo_left = max(first_col - 1, 0)
+    halo_right = min(last_col + 1, arr.shape[1])
+    padded[
+        halo_top - first_row + 1 : halo_bottom - first_row + 1,
+        halo_left - first_col + 1 : halo_right - first_col + 1,
+    ] = arr[halo_top:halo_bottom, halo_left:halo_right]
+
+    # Work out which cells exist once; each neighbour's mask is then just a
+    # shifted view of it, and Z is only looked up for the corners used
+    valid = padded > NODATA
+
+    def neighbour(offset):
+        return valid[
+            1 + offset[0] : 1 + offset[0] + num_rows,
+            1 + offset[1] : 1 + offset[1] + num_cols,
+        ]
+
+    c, t, tr, tl, l, r, bl, b, br = [
+        neighbour(offset) for offset in (C, T, TR, TL, L, R, BL, B, BR)
+    ]
+
+    def corners(mask, *offsets):
+        """
+        Returns an (N, 3) array of points for each offset, one row per
+        cell in mask.
+        """
+        index = numpy.argwhere(mask)
+        points = []
+        for offset in offsets:
+            i = index[:, 0] + offset[0]
+            j = index[:, 1] + offset[1]
+            points.append(
+                numpy.stack(
+                    [
+                        i + first_row + origin[0],
+                        j + first_col + origin[1],
+                        padded[i + 1, j + 1],
+                    ],
+                    axis=1,
+                ).astype(numpy.float32)
+            )
+        return points
+
+    # Centre-Right-Bottom triangle
+    crb = c & r & b
+    mesh.add_surfaces(*corners(crb, C, R, B))
+    # Add diagonal edge if BR is nonexistent
+    mesh.add_edges(*corners(crb & ~br, B, R))
+    # Top edge
+    mesh.add_edges(*corners(crb & ~t & ~tr, R, C))
+    # Left edge
+    mesh.add_edges(*corners(crb & ~l & ~bl, C, B))
+    # Top-centre-left triangle
+    tcl = c & t & l
+    mesh.add_surfaces(*corners(tcl, T, C, L))
+    # Add diagonal edge if TL is nonexistent
+    mesh.add_edges(*corners(tcl & ~tl, T, L))
+    # Right edge
+    mesh.add_edges(*corners(tcl & ~r & ~tr, C, T))
+    # Bottom edge
+    mesh.add_edges(*corners(tcl & ~b & ~bl, L, C))
+    # Top-right-center triangle (if tr doesn't exist)
+    trc = c & t & r & ~tr
+    mesh.add_surfaces(*corners(trc, T, R, C))
+    # Also implies there must be an edge there
+    mesh.add_edges(*corners(trc, R, T))
+    # See if it needs a left edge
+    mesh.add_edges(*corners(trc & ~l & ~tl, T, C))
+    # Bottom edge
+    mesh.add_edges(*corners(trc & ~b & ~br, C, R))
+    # Left-center-bottom triangle (if bl doesn't exist)
+    lcb = c & l & b & ~bl
+    mesh.add_surfaces(*corners(lcb, L, C, B))
+    # Also implies there must be an edge there
+    mesh.add_edges(*corners(lcb, L, B))
+    # See if it needs a right edge
+    mesh.add_edges(*corners(lcb & ~r & ~br, B, C))
+    # And a top edge
+    mesh.add_edges(*corners(lcb & ~t & ~tr, C, L))
 
 
 class Mesh:
@@ -174,204 +332,417 @@ class Mesh:
     Represents a mesh of the geography.
     """
 
-    def __init__(self, scale, z_reduction=1):
+    # How many neighbours simplify tries to merge a lone vertex into, per pass
+    merge_attempts = 8
+
+    # The largest X/Y position a vertex can have (see vertex_keys)
+    max_position = 0xFFFF
+
+    def __init__(self, scale, z_reduction=1, bottom=0):
         self.scale = scale or (1, 1, 1)
         self.z_reduction = z_reduction
-        # Dict of (x, y, z): index
-        self.vertices = collections.OrderedDict()
-        # List of (v1, v2, v3, normal)
-        self.faces = []
-
-    def vertex_index(self, vertex):
-        """
-        Returns the vertex's index, adding it if needed
-        """
-        assert len(vertex) == 3
-        z_units = vertex[2] / 100.0
-        z_scale = self.scale[2] * (self.z_reduction ** z_units)
-        vertex = (
-            vertex[0] * self.scale[0],
-            vertex[1] * self.scale[1],
-            vertex[2] * z_scale,
+        # Z value (unscaled) of the flat base of the model
+        self.bottom = bottom
+        # (V, 3) array of unique, unscaled vertex positions
+        self.vertices = numpy.empty((0, 3), dtype=numpy.float32)
+        # Faces, stored as parallel (N, 3) arrays of normals and vertex
+        # indices. They have spare room on the end to add more faces; only
+        # the first n_faces rows are used.
+        self.normals = numpy.empty((0, 3), dtype=numpy.float32)
+        self.face_idx = numpy.empty((0, 3), dtype=numpy.int32)
+        self.n_faces = 0
+        # Vertex keys (see vertex_keys) of the corners of the last n_pending
+        # faces, whose vertices are not yet in the vertex table (and so have
+        # no face_idx)
+        self.pending_keys = numpy.empty((0, 3), dtype=numpy.uint64)
+        self.n_pending = 0
+
+    def reserve(self, num_faces):
+        """
+        Makes sure there is room to add num_faces more faces, growing the
+        face arrays (at least doubling them) if needed.
+        """
+
+        def grow(array, needed):
+            if needed <= len(array):
+                return array
+            grown = numpy.empty(
+                (max(needed, 2 * len(array)),) + array.shape[1:], dtype=array.dtype
+            )
+            grown[: len(array)] = array
+            return grown
+
+        self.normals = grow(self.normals, self.n_faces + num_faces)
+        self.face_idx = grow(self.face_idx, self.n_faces + num_faces)
+        self.pending_keys = grow(self.pending_keys, self.n_pending + num_faces)
+
+    @staticmethod
+    def vertex_keys(points):
+        """
+        Packs an (N, 3) array of points into uint64 keys, so each vertex can
+        be looked up as a single integer. X and Y must be whole numbers
+        from 0 to max_position (they're array positions) and get 16 bits
+        each; Z gets the other 32 bits, as a float32.
+        """
+        if len(points) and (
+            points[:, :2].min() < 0 or points[:, :2].max() > Mesh.max_position
+        ):
+            raise ValueError(
+                "Mesh X/Y positions must be between 0 and %i" % Mesh.max_position
+            )
+        xy = points[:, :2].astype(numpy.uint64)
+        # Adding zero turns -0.0 into 0.0, so they get the same key
+        z = points[:, 2].astype(numpy.float32) + numpy.float32(0)
+        return (
+            (xy[:, 0] << numpy.uint64(48))
+            | (xy[:, 1] << numpy.uint64(32))
+            | z.view(numpy.uint32).astype(numpy.uint64)
         )
-        if vertex not in self.vertices:
-            self.vertices[vertex] = len(self.vertices)
-        return self.vertices[vertex]
+
+    @staticmethod
+    def normal_keys(normals):
+        """
+        Packs an (N, 3) array of unit normals into int64 keys, rounding each
+        component to a millionth, so faces facing the same way share a key.
+        """
+        # Each component becomes 0 - 2,000,000, which fits in 21 bits
+        quantized = numpy.rint(normals * 1e6).astype(numpy.int64) + 1000000
+        return (quantized[:, 0] << 42) | (quantized[:, 1] << 21) | quantized[:, 2]
+
+    @staticmethod
+    def key_vertices(keys):
+        """
+        Unpacks uint64 vertex keys back into an (N, 3) float32 array.
+        """
+        vertices = numpy.empty((len(keys), 3), dtype=numpy.float32)
+        vertices[:, 0] = keys >> numpy.uint64(48)
+        vertices[:, 1] = (keys >> numpy.uint64(32)) & numpy.uint64(0xFFFF)
+        vertices[:, 2] = (
+            (keys & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32).view(numpy.float32)
+        )
+        return vertices
+
+    def index_vertices(self):
+        """
+        Deduplicates the corners of any newly-added faces into the vertex
+        table, filling in their vertex indices.
+        """
+        if not self.n_pending:
+            return
+        # Uniquify the keys of the old vertices and the new corners all
+        # together. Sorting them is quicker than hashing them in numpy (the
+        # keys mostly arrive in order), and leaves the vertices in grid
+        # order, which keeps simplify's lookups close together.
+        keys = numpy.concatenate(
+            [
+                self.vertex_keys(self.vertices),
+                self.pending_keys[: self.n_pending].ravel(),
+            ]
+        )
+        unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+        inverse = inverse.reshape(-1).astype(numpy.int32)
+        old_map = inverse[: len(self.vertices)]
+        new_indices = inverse[len(self.vertices) :].reshape(-1, 3)
+        first_pending = self.n_faces - self.n_pending
+        self.vertices = self.key_vertices(unique_keys)
+        self.face_idx[:first_pending] = old_map[self.face_idx[:first_pending]]
+        self.face_idx[first_pending : self.n_faces] = new_indices
+        # Free up the keys; they're not needed until more faces are added
+        self.pending_keys = numpy.empty((0, 3), dtype=numpy.uint64)
+        self.n_pending = 0
+
+    def scaled_vertices(self):
+        """
+        Returns the vertex table with the model scale applied.
+        """
+        vertices = self.vertices.copy()
+        z_units = vertices[:, 2] / numpy.float32(100)
+        vertices[:, 0] *= self.scale[0]
+        vertices[:, 1] *= self.scale[1]
+        vertices[:, 2] *= numpy.float32(self.scale[2]) * (
+            numpy.float32(self.z_reduction) ** z_units
+        )
+        return vertices
 
     def add_triangle(self, point1, point2, point3):
         """
         Adds a single triangle
         """
-        # Get vertex indices
-        i1 = self.vertex_index(point1)
-        i2 = self.vertex_index(point2)
-        i3 = self.vertex_index(point3)
-        # Calculate normal (clockwise)
-        u = (point2[0] - point1[0], point2[1] - point1[1], point2[2] - point1[2])
-        v = (point3[0] - point1[0], point3[1] - point1[1], point3[2] - point1[2])
-        normal = (
-            (u[1] * v[2]) - (u[2] * v[1]),
-            (u[2] * v[0]) - (u[0] * v[2]),
-            (u[0] * v[1]) - (u[1] * v[0]),
+        self.add_triangles_bulk(
+            numpy.array([point1], dtype=numpy.float32),
+            numpy.array([point2], dtype=numpy.float32),
+            numpy.array([point3], dtype=numpy.float32),
         )
-        normal_magnitude = (
-            (normal[0] ** 2) + (normal[1] ** 2) + (normal[2] ** 2)
-        ) ** 0.5
-        normal = (
-            normal[0] / normal_magnitude,
-            normal[1] / normal_magnitude,
-            normal[2] / normal_magnitude,
-        )
-        # Add face
-        self.faces.append((normal, i1, i2, i3))
 
-    def add_quad(self, point1, point2, point3, point4):
+    def add_triangles_bulk(self, points1, points2, points3):
         """
-        Adds a quad to the file, made out of two facets. Pass vertices in
-        clockwise order.
+        Adds many triangles at once, from three (N, 3) float32 arrays of
+        corners. X and Y must be whole numbers (see vertex_keys).
         """
-        self.add_triangle(point1, point2, point4)
-        self.add_triangle(point2, point3, point4)
+        num_faces = len(points1)
+        self.reserve(num_faces)
+        # Calculate normals (clockwise)
+        normals = self.normals[self.n_faces : self.n_faces + num_faces]
+        normals[:] = numpy.cross(points2 - points1, points3 - points1)
+        normals /= numpy.linalg.norm(normals, axis=1, keepdims=True)
+        # Add faces; their face_idx is filled in by index_vertices
+        keys = self.pending_keys[self.n_pending : self.n_pending + num_faces]
+        keys[:, 0] = self.vertex_keys(points1)
+        keys[:, 1] = self.vertex_keys(points2)
+        keys[:, 2] = self.vertex_keys(points3)
+        self.n_faces += num_faces
+        self.n_pending += num_faces
 
-    def add_surface(self, point1, point2, point3, bottom):
+    def add_faces(self, normals, keys):
+        """
+        Adds faces that have already been worked out (by another Mesh), from
+        an (N, 3) array of their normals and one of their vertex keys.
         """
-        Adds a facet with a matching flat bottom polygon.
-        Points should be clockwise looking from the top.
+        num_faces = len(normals)
+        self.reserve(num_faces)
+        self.normals[self.n_faces : self.n_faces + num_faces] = normals
+        self.pending_keys[self.n_pending : self.n_pending + num_faces] = keys
+        self.n_faces += num_faces
+        self.n_pending += num_faces
+
+    def add_quads(self, points1, points2, points3, points4):
         """
-        self.add_triangle(
-            (point1[0], point1[1], point1[2]),
-            (point2[0], point2[1], point2[2]),
-            (point3[0], point3[1], point3[2]),
+        Adds quads to the file, each made out of two facets. Pass (N, 3)
+        arrays of vertices in clockwise order.
+        """
+        self.add_triangles_bulk(points1, points2, points4)
+        self.add_triangles_bulk(points2, points3, points4)
+
+    def at_bottom(self, points):
+        """
+        Returns a copy of an (N, 3) array of points, dropped to the bottom.
+        """
+        bottom_points = numpy.empty_like(points)
+        bottom_points[:, :2] = points[:, :2]
+        bottom_points[:, 2] = self.bottom
+        return bottom_points
+
+    def add_surfaces(self, points1, points2, points3):
+        """
+        Adds facets with matching flat bottom polygons, from (N, 3) arrays
+        of vertices. Points should be clockwise looking from the top.
+        """
+        self.add_triangles_bulk(points1, points2, points3)
+        self.add_triangles_bulk(
+            self.at_bottom(points1), self.at_bottom(points3), self.at_bottom(points2)
         )
-        self.add_triangle(
-            (point1[0], point1[1], bottom),
-            (point3[0], point3[1], bottom),
-            (point2[0], point2[1], bottom),
+
+    def add_edges(self, points1, points2):
+        """
+        Adds quads to form edges between the pairs of vertices in two (N, 3)
+        arrays. Vertices should be left, right looking from the outside of
+        the model.
+        """
+        self.add_quads(
+            points1, points2, self.at_bottom(points2), self.at_bottom(points1)
         )
 
-    def add_edge(self, point1, point2, bottom):
+    def simplify(self, progress=None):
+        """
+        Simplifies the mesh via edge-merging, in passes until one barely
+        changes anything; a few awkward vertices can take many passes to get
+        rid of. Calls progress (if given) after each pass, and returns the
+        number of vertices removed.
+        """
+        self.index_vertices()
+        normal_keys = self.normal_keys(self.normals[: self.n_faces])
+        total_removed = 0
+        while len(self.vertices):
+            num_vertices = len(self.vertices)
+            normal_keys = normal_keys[self.simplify_pass(normal_keys)]
+            total_removed += num_vertices - len(self.vertices)
+            if progress:
+                progress()
+            if num_vertices - len(self.vertices) <= len(self.vertices) / 1000:
+                break
+        return total_removed
+
+    def simplify_pass(self, normal_keys):
         """
-        Adds a quad to form an edge between the two vertices.
-        Vertices should be left, right looking from the outside of the model.
+        Does one pass of simplify. Finds vertices whose attached faces all
+        have the same normal key (as do their neighbours'), and collapses
+        them into a neighbour, as long as that doesn't turn any faces over.
+        Returns which of the faces (and so their normal keys) were kept.
+
+        Works on the whole mesh at once: some of the flat vertices are picked
+        as hubs (no two next to each other), and the rest merge into them.
         """
-        self.add_quad(
-            (point1[0], point1[1], point1[2]),
-            (point2[0], point2[1], point2[2]),
-            (point2[0], point2[1], bottom),
-            (point1[0], point1[1], bottom),
+        num_vertices = len(self.vertices)
+        faces = self.face_idx[: self.n_faces]
+        normals = self.normals[: self.n_faces]
+        # Work out which vertices are flat, by seeing if the normal keys of
+        # their faces vary. Every vertex is on a face, so no group is empty.
+        order = numpy.argsort(faces.ravel())
+        vertex_normal_keys = normal_keys[order // 3]
+        face_starts = numpy.concatenate(
+            [[0], numpy.cumsum(numpy.bincount(faces.ravel()))[:-1]]
+        )
+        flat = numpy.maximum.reduceat(
+            vertex_normal_keys, face_starts
+        ) == numpy.minimum.reduceat(vertex_normal_keys, face_starts)
+        # Build the neighbour graph in CSR form, from each face's edges in
+        # both directions. Edges are shared by faces, so pack each into one
+        # integer (source in the top half) and sort them, which groups them
+        # by source and puts repeats next to each other to be dropped.
+        sources = faces[:, [0, 0, 1, 1, 2, 2]].ravel().astype(numpy.uint64)
+        edges = (sources << numpy.uint64(32)) | faces[
+            :, [1, 2, 0, 2, 0, 1]
+        ].ravel().astype(numpy.uint64)
+        edges.sort()
+        edges = edges[numpy.concatenate([[True], edges[1:] != edges[:-1]])]
+        neighbours = (edges & numpy.uint64(0xFFFFFFFF)).astype(numpy.int32)
+        degrees = numpy.bincount(
+            (edges >> numpy.uint64(32)).astype(numpy.int32), minlength=num_vertices
+        )
+        row_starts = numpy.concatenate([[0], numpy.cumsum(degrees)[:-1]])
+        # Only flat vertices with all-flat neighbours can be merged; a flat
+        # vertex shares a face (and so a normal) with each neighbour.
+        mergeable = flat & numpy.logical_and.reduceat(flat[neighbours], row_starts)
+        # Give every vertex a pseudo-random priority; it varies between
+        # passes, so vertices that couldn't merge get a different go next
+        # time. Neighbours are ranked by priority, then index.
+        vertex_numbers = numpy.arange(num_vertices, dtype=numpy.int32)
+        priority = (
+            (vertex_numbers.astype(numpy.uint64) + numpy.uint64(num_vertices))
+            * numpy.uint64(2654435761)
+        ) & numpy.uint64(0xFFFFFFFF)
+        ranks = (priority[neighbours] << numpy.uint64(32)) | neighbours.astype(
+            numpy.uint64
         )
+        no_rank = numpy.uint64(0xFFFFFFFFFFFFFFFF)
 
-    def simplify(self):
-        """
-        Simplifies the mesh via edge-merging. Goes through all edges, and sees
-        if all faces attached to that edge have the same normal. If so, collapses
-        it.
-        """
-        # Create a map of vertex indexes to the normals of the faces attached to them,
-        # and vertices to their neighbours
-        non_flat_vertices = set()
-        vertex_face_normals = {}
-        vertex_neighbours = {v: [] for v in self.vertices.values()}
-        for normal, v1, v2, v3 in self.faces:
-            # Work out if it has flat normals
-            for v in (v1, v2, v3):
-                if v not in non_flat_vertices:
-                    if v in vertex_face_normals:
-                        if vertex_face_normals[v] != normal:
-                            non_flat_vertices.add(v)
-                            del vertex_face_normals[v]
-                    else:
-                        vertex_face_normals[v] = normal
-            # Add it to the neighbour graph
-            vertex_neighbours[v1].extend([v2, v3])
-            vertex_neighbours[v2].extend([v1, v3])
-            vertex_neighbours[v3].extend([v1, v2])
-        # Go through edges, and remove those whose normals match.
-        # Keep track of tainted vertices that we can't touch this iteration.
-        tainted_vertices = set()
-        merged_vertices = {}
-        for index, vertex in enumerate(self.vertices):
-            # Skip non-flat vertices
-            if index not in vertex_face_normals:
-                continue
-            # Skip vertices whose neighbours were already touched
-            if index in tainted_vertices:
-                continue
-            # Skip vertices which have non-flat neighbours
-            if not all(
-                neighbour in vertex_face_normals
-                for neighbour in vertex_neighbours[index]
-            ):
-                continue
-            # See if there's a neighbour we can merge with
-            for neighbour in vertex_neighbours[index]:
-                if (
-                    neighbour in vertex_face_normals
-                    and vertex_face_normals[neighbour] == vertex_face_normals[index]
-                ):
-                    # Mark them for merge
-                    merged_vertices[index] = neighbour
-                    # Mark them as tainted so we don't revisit them
-                    tainted_vertices.add(index)
-                    tainted_vertices.add(neighbour)
-                    break
-        # Rewrite mesh with the new vertices and faces
-        new_vertices = collections.OrderedDict()
-        new_faces = []
-        vertex_map = {}  # Maps old index to new one
-        # First, write all unmerged vertices out
-        for index, vertex in enumerate(self.vertices):
-            if index not in merged_vertices:
-                vertex_map[index] = len(new_vertices)
-                new_vertices[vertex] = len(new_vertices)
-        # Then, add mappings for the merged vertices
-        for vertex, merged_to in merged_vertices.items():
-            vertex_map[vertex] = vertex_map[merged_to]
-        # Finally, rewrite all the faces, removing those that are now zero sized
-        for normal, v1, v2, v3 in self.faces:
-            new1 = vertex_map[v1]
-            new2 = vertex_map[v2]
-            new3 = vertex_map[v3]
-            # Skip face if it's now zero size
-            if new1 == new2 or new2 == new3 or new3 == new1:
-                continue
-            new_faces.append((normal, new1, new2, new3))
-        self.vertices = new_vertices
-        self.faces = new_faces
-        return len(merged_vertices)
+        def best_neighbour(allowed):
+            """
+            Returns the highest-ranked allowed neighbour of each vertex, or
+            -1 if there is none.
+            """
+            best = numpy.minimum.reduceat(
+                numpy.where(allowed[neighbours], ranks, no_rank), row_starts
+            )
+            return numpy.where(
+                best == no_rank, -1, best & numpy.uint64(0xFFFFFFFF)
+            ).astype(numpy.int32)
+
+        def turned_over(face_numbers, new_faces):
+            """
+            Works out which of the rewritten faces now point the wrong way
+            (or have no area). Faces that collapse to a line are fine, as
+            they get removed.
+            """
+            points = self.vertices[new_faces]
+            new_normals = numpy.cross(
+                points[:, 1] - points[:, 0], points[:, 2] - points[:, 0]
+            )
+            return (
+                (numpy.einsum("ij,ij->i", new_normals, normals[face_numbers]) <= 0)
+                & (new_faces[:, 0] != new_faces[:, 1])
+                & (new_faces[:, 1] != new_faces[:, 2])
+                & (new_faces[:, 2] != new_faces[:, 0])
+            )
+
+        # Pick hubs in rounds: take any mergeable vertex that outranks all
+        # its remaining neighbours, then rule out its neighbours.
+        hubs = numpy.zeros(num_vertices, dtype=bool)
+        remaining = mergeable
+        while remaining.any():
+            best = best_neighbour(remaining)
+            picked = remaining & ((best < 0) | (priority < priority[best]))
+            hubs |= picked
+            remaining = (
+                remaining
+                & ~picked
+                & ~numpy.logical_or.reduceat(picked[neighbours], row_starts)
+            )
+        # Merge every other mergeable vertex into its best hub, then undo
+        # any merges that turn faces over, until there are none
+        index_map = vertex_numbers.copy()
+        merged = mergeable & ~hubs
+        index_map[merged] = best_neighbour(hubs)[merged]
+        while True:
+            new_faces = index_map[faces]
+            moved = new_faces != faces
+            changed = numpy.flatnonzero(moved.any(axis=1))
+            flipped = changed[turned_over(changed, new_faces[changed])]
+            if not len(flipped):
+                break
+            undone = faces[flipped][moved[flipped]]
+            index_map[undone] = undone
+        # Hubs with nothing merging into them can merge into a neighbour
+        # themselves instead, as their neighbours aren't moving. Try a few
+        # neighbours in turn (starting somewhere different each pass) until
+        # one works.
+        moving = index_map != vertex_numbers
+        lonely = hubs & ~numpy.logical_or.reduceat(moving[neighbours], row_starts)
+        face_numbers, corners = numpy.nonzero(lonely[faces])
+        lonely = numpy.flatnonzero(lonely)
+        # Which of the lonely hubs each of their face corners belongs to
+        owners = numpy.searchsorted(lonely, faces[face_numbers, corners])
+        trying = numpy.ones(len(lonely), dtype=bool)
+        attempt = 0
+        while trying.any() and attempt < self.merge_attempts:
+            targets = neighbours[
+                row_starts[lonely]
+                + (priority[lonely].astype(numpy.int64) + attempt) % degrees[lonely]
+            ]
+            corners_trying = numpy.flatnonzero(trying[owners])
+            new_faces = faces[face_numbers[corners_trying]]
+            new_faces[
+                numpy.arange(len(corners_trying)), corners[corners_trying]
+            ] = targets[owners[corners_trying]]
+            failed = numpy.zeros(len(lonely), dtype=bool)
+            failed[
+                owners[corners_trying][
+                    turned_over(face_numbers[corners_trying], new_faces)
+                ]
+            ] = True
+            index_map[lonely[trying & ~failed]] = targets[trying & ~failed]
+            trying &= failed
+            attempt += 1
+        faces = index_map[faces]
+        # Rewrite the faces, removing those that are now zero sized
+        keep = (
+            (faces[:, 0] != faces[:, 1])
+            & (faces[:, 1] != faces[:, 2])
+            & (faces[:, 2] != faces[:, 0])
+        )
+        faces = faces[keep]
+        # Drop vertices that are no longer used, and renumber the rest
+        used = numpy.zeros(num_vertices, dtype=bool)
+        used[faces.ravel()] = True
+        index_map = (numpy.cumsum(used) - 1).astype(numpy.int32)
+        self.vertices = self.vertices[used]
+        self.normals[: len(faces)] = normals[keep]
+        self.face_idx[: len(faces)] = index_map[faces]
+        self.n_faces = len(faces)
+        return keep
 
     def save(self, path):
         """
         Saves the mesh as an STL file
         """
-        # Invert vertices to be mapped by index (well, a list)
-        vertex_list = list(self.vertices.keys())
-        # Write STL file
-        with open(path, "wb") as fh:
-            # Write STL header
-            fh.write(b" " * 80)  # Textual header
-            fh.write(struct.pack(b"<L", len(self.faces)))  # The number of facets
-            # Write facets
-            for normal, i1, i2, i3 in self.faces:
-                vertex1 = vertex_list[i1]
-                vertex2 = vertex_list[i2]
-                vertex3 = vertex_list[i3]
-                # Write out entry
-                fh.write(
-                    struct.pack(
-                        b"<ffffffffffffH",
-                        normal[0],
-                        normal[1],
-                        normal[2],
-                        vertex1[0],
-                        vertex1[1],
-                        vertex1[2],
-                        vertex2[0],
-                        vertex2[1],
-                        vertex2[2],
-                        vertex3[0],
-                        vertex3[1],
-                        vertex3[2],
-                        0,
-                    )
+        self.index_vertices()
+        vertices = self.scaled_vertices()
+        faces = self.face_idx[: self.n_faces]
+        # Make the file its final size and map it into memory, so the facet
+        # records can be filled in where they'll be written
+        with open(path, "wb+") as fh:
+            fh.truncate(STL_HEADER.size + STL_DTYPE.itemsize * self.n_faces)
+            with mmap.mmap(fh.fileno(), 0) as mm:
+                # Write STL header
+                STL_HEADER.pack_into(mm, 0, b" " * 80, self.n_faces)
+                # Write facets, with vertices mapped by index. The file
+                # starts out zeroed, so the attributes are already 0.
+                records = numpy.frombuffer(
+                    mm, dtype=STL_DTYPE, count=self.n_faces, offset=STL_HEADER.size
                 )
+                records["normal"] = self.normals[: self.n_faces]
+                records["v1"] = vertices[faces[:, 0]]
+                records["v2"] = vertices[faces[:, 1]]
+                records["v3"] = vertices[faces[:, 2]]
+                # Let go of the mapping before it's closed
+                del records